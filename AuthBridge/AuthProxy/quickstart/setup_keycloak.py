@@ -1,21 +1,120 @@
-from keycloak import KeycloakAdmin, KeycloakGetError, KeycloakPostError
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from keycloak import KeycloakAdmin, KeycloakPostError
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
 
 KEYCLOAK_URL = "http://keycloak.localtest.me:8080"
 KEYCLOAK_REALM = "demo"
 KEYCLOAK_ADMIN_USERNAME = "admin"
 KEYCLOAK_ADMIN_PASSWORD = "admin"
+# (connect, read) timeout in seconds for every Keycloak request
+KEYCLOAK_TIMEOUT = (3, 10)
+# Concurrent admin calls per setup() stage, and the keep-alive pool they share; the
+# same limits as MAX_WORKERS and KeycloakSetup's pool in AuthBridge/keycloak_utils.py
+MAX_WORKERS = 4
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 32
+# Parameters of the pre-hashed test user password. Keycloak re-hashes a credential on the
+# first login when the realm's password policy asks for something else, so these follow
+# the default policy of current Keycloak releases (512-bit derived key).
+PASSWORD_HASH_ALGORITHM = "pbkdf2-sha512"
+PASSWORD_HASH_ITERATIONS = 210000
+PASSWORD_HASH_KEY_BYTES = 64
+
+# Everything setup() creates in the realm
+TEST_USER = {"username": "test-user", "password": "password"}
+CLIENTS = [
+    {
+        "clientId": "application-caller",
+        "name": "Application Caller",
+        "enabled": True,
+        "publicClient": False,  # Creates a confidential client (Client Auth)
+        "directAccessGrantsEnabled": True,
+        "standardFlowEnabled": False
+    },
+    {
+        "clientId": "authproxy",
+        "name": "Auth Proxy",
+        "enabled": True,
+        "publicClient": False,  # Confidential client
+        "standardFlowEnabled": False,
+        "serviceAccountsEnabled": True,
+        "attributes": {
+            "standard.token.exchange.enabled": "true"
+        }
+    },
+]
+CLIENT_SCOPES = [
+    {
+        "name": scope_name,
+        "protocol": "openid-connect",
+        "attributes": {
+            "include.in.token.scope": "true",
+            "display.on.consent.screen": "true"
+        }
+    }
+    for scope_name in ("authproxy-aud", "demoapp-aud")
+]
+# (client scope, audience its mapper adds to tokens)
+AUDIENCE_MAPPERS = [("authproxy-aud", "authproxy"), ("demoapp-aud", "demoapp")]
+# (client, client scope assigned to it as a default scope)
+DEFAULT_SCOPE_ASSIGNMENTS = [("application-caller", "authproxy-aud"), ("authproxy", "demoapp-aud")]
+
+# Realm attribute holding the hash of the last setup, see skip_if_unchanged
+SETUP_FINGERPRINT_ATTRIBUTE = "kagenti-quickstart-setup-hash"
+
+# Indexes of the current realm's client scopes (by name, including their
+# protocolMappers), clients (by clientId) and mapper names (by scope ID). setup()
+# fills them from one listing each so the helpers below don't re-list the realm.
+_scope_cache = {}
+_client_cache = {}
+_mapper_cache = {}
+# Default client scope IDs per client ID, listed at most once per client
+_client_default_scope_cache = {}
 
 # Helper functions
-def get_or_create_user(keycloak_admin, username):
-    users = keycloak_admin.get_users({"username": username})
-    user_id = None
+def password_credential(password):
+    """
+    Builds a non-temporary password credential that is already PBKDF2-hashed, so Keycloak
+    stores it as-is instead of hashing it during user creation.
+    """
+    salt = os.urandom(16)
+    hashed = hashlib.pbkdf2_hmac(
+        "sha512", password.encode(), salt, PASSWORD_HASH_ITERATIONS, PASSWORD_HASH_KEY_BYTES
+    )
+    return {
+        "type": "password",
+        "secretData": json.dumps({
+            "value": base64.b64encode(hashed).decode(),
+            "salt": base64.b64encode(salt).decode(),
+        }),
+        "credentialData": json.dumps({
+            "hashIterations": PASSWORD_HASH_ITERATIONS,
+            "algorithm": PASSWORD_HASH_ALGORITHM,
+        }),
+        "temporary": False
+    }
+
+def get_or_create_user(keycloak_admin, username, password):
+    # Let Keycloak match the username exactly instead of filtering a fuzzy search here
+    users = keycloak_admin.get_users({
+        "username": username, "exact": "true", "max": 1, "briefRepresentation": "true"
+    })
     if users:
-        # Filter strictly because search is fuzzy
-        existing_user = next((u for u in users if u['username'] == username), None)
-        if existing_user:
-            user_id = existing_user['id']
-            print(f"User '{username}' already exists.")
-    if not user_id:
+        user_id = users[0]['id']
+        logger.info(f"User '{username}' already exists.")
+    else:
         user_id = keycloak_admin.create_user({
             "username": username,
             "enabled": True,
@@ -23,147 +122,319 @@ def get_or_create_user(keycloak_admin, username):
             "emailVerified": True,
             "firstName": username,
             "lastName": username,
-        }, True)
-        print(f"Created user '{username}'.")
+            "credentials": [password_credential(password)]
+        }, exist_ok=False)  # already looked up above; exist_ok=True would look it up again
+        logger.info(f"Created user '{username}'.")
     return user_id
 
 def get_or_create_client(keycloak_admin, client_payload):
-    existing_client_id = keycloak_admin.get_client_id(client_payload["clientId"])
-    if existing_client_id:
-        print(f"Client '{client_payload["clientId"]}' already exists.")
-        return existing_client_id
-    client_id = keycloak_admin.create_client(client_payload)
-    print(f"Created client '{client_payload["clientId"]}'.")
-    return client_id
+    client_id = client_payload["clientId"]
+    existing_client = _client_cache.get(client_id)
+    if existing_client:
+        logger.info(f"Client '{client_id}' already exists.")
+        return existing_client['id']
+    internal_id = keycloak_admin.create_client(client_payload)
+    _client_cache[client_id] = {**client_payload, "id": internal_id}
+    logger.info(f"Created client '{client_id}'.")
+    return internal_id
 
-def get_or_create_client_scope(keycloak_admin, scope_payload):
+def audience_mapper_payload(mapper_name, audience):
+    """
+    Builds a protocol mapper that adds the given audience to access tokens.
+    """
+    return {
+        "name": mapper_name,
+        "protocol": "openid-connect",
+        "protocolMapper": "oidc-audience-mapper",
+        "consentRequired": False,
+        "config": {
+            "included.custom.audience": audience,
+            "id.token.claim": "false",
+            "access.token.claim": "true",
+            "userinfo.token.claim": "false"
+        }
+    }
+
+def get_or_create_client_scope(keycloak_admin, scope_payload, mappers=()):
     """
     Creates a client scope if it doesn't exist, or returns the ID of the existing one.
+    A new scope is created with the given protocol mappers in the same request.
     """
     scope_name = scope_payload.get("name")
     
-    # Keycloak python wrapper doesn't have a direct 'get_scope_id', so we list and filter
-    scopes = keycloak_admin.get_client_scopes()
-    for scope in scopes:
-        if scope['name'] == scope_name:
-            print(f"Client scope '{scope_name}' already exists with ID: {scope['id']}")
-            return scope['id']
+    # Keycloak python wrapper doesn't have a direct 'get_scope_id', so we look it
+    # up in the scope list fetched once at startup
+    existing_scope = _scope_cache.get(scope_name)
+    if existing_scope:
+        logger.info(f"Client scope '{scope_name}' already exists with ID: {existing_scope['id']}")
+        return existing_scope['id']
 
     # Create new scope
+    if mappers:
+        scope_payload = {**scope_payload, "protocolMappers": list(mappers)}
     try:
         scope_id = keycloak_admin.create_client_scope(scope_payload)
-        print(f"Created client scope '{scope_name}': {scope_id}")
+        _scope_cache[scope_name] = {**scope_payload, "id": scope_id}
+        _mapper_cache[scope_id] = {m['name'] for m in mappers}
+        logger.info(f"Created client scope '{scope_name}': {scope_id}")
+        for mapper in mappers:
+            logger.info(f"Added audience mapper '{mapper['name']}' for audience "
+                        f"'{mapper['config']['included.custom.audience']}'")
         return scope_id
     except KeycloakPostError as e:
-        print(f"Could not create client scope '{scope_name}': {e}")
+        logger.error(f"Could not create client scope '{scope_name}': {e}")
         raise
 
+def get_scope_mapper_names(keycloak_admin, scope_id):
+    """
+    Returns the names of a client scope's protocol mappers, listing them at most once per scope.
+    """
+    if scope_id not in _mapper_cache:
+        mappers = keycloak_admin.get_mappers_from_client_scope(scope_id)
+        _mapper_cache[scope_id] = {m['name'] for m in mappers}
+    return _mapper_cache[scope_id]
+
 def add_audience_mapper(keycloak_admin, scope_id, mapper_name, audience):
     """
     Adds an audience protocol mapper to a client scope if it doesn't already exist.
+    New scopes get their mapper inline, so this only repairs scopes that predate the run.
+    Returns whether the scope has the mapper afterwards.
     """
-    # Note: we do not pre-check for existing mappers here; Keycloak will handle duplicates or raise errors.
+    existing_mappers = get_scope_mapper_names(keycloak_admin, scope_id)
+    if mapper_name in existing_mappers:
+        logger.info(f"Audience mapper '{mapper_name}' already exists.")
+        return True
 
-    mapper_payload = {
-        "name": mapper_name,
-        "protocol": "openid-connect",
-        "protocolMapper": "oidc-audience-mapper",
-        "consentRequired": False,
-        "config": {
-            "included.custom.audience": audience,
-            "id.token.claim": "false",
-            "access.token.claim": "true",
-            "userinfo.token.claim": "false"
-        }
-    }
-    
     try:
-        keycloak_admin.add_mapper_to_client_scope(scope_id, mapper_payload)
-        print(f"Added audience mapper '{mapper_name}' for audience '{audience}'")
+        keycloak_admin.add_mapper_to_client_scope(scope_id, audience_mapper_payload(mapper_name, audience))
+        existing_mappers.add(mapper_name)
+        logger.info(f"Added audience mapper '{mapper_name}' for audience '{audience}'")
+        return True
     except Exception as e:
-        print(f"Failed to add mapper '{mapper_name}': {e}")
-
-# initialize keycloak admin client
-print(f"Connecting to Keycloak at {KEYCLOAK_URL} as {KEYCLOAK_ADMIN_USERNAME}...")
-keycloak_admin = KeycloakAdmin(
-    server_url=KEYCLOAK_URL,
-    username=KEYCLOAK_ADMIN_USERNAME,
-    password=KEYCLOAK_ADMIN_PASSWORD,
-    realm_name=KEYCLOAK_REALM,
-    user_realm_name="master"
-)
-
-# create test-user
-test_user_name = "test-user"
-user_id = get_or_create_user(keycloak_admin, test_user_name)
-keycloak_admin.set_user_password(user_id, "password", temporary=False)
-print(f"Set password for '{test_user_name}'.")
-
-# Create application-caller Client
-app_caller_id = get_or_create_client(keycloak_admin, {
-    "clientId": "application-caller",
-    "name": "Application Caller",
-    "enabled": True,
-    "publicClient": False,  # Creates a confidential client (Client Auth)
-    "directAccessGrantsEnabled": True,
-    "standardFlowEnabled": False
-})
-
-# Create authproxy Client
-authproxy_id = get_or_create_client(keycloak_admin, {
-    "clientId": "authproxy",
-    "name": "Auth Proxy",
-    "enabled": True,
-    "publicClient": False,  # Confidential client
-    "standardFlowEnabled": False,
-    "serviceAccountsEnabled": True,
-    "attributes": {
-        "standard.token.exchange.enabled": "true"
-    }
-})
-
-# Create `authproxy-aud` Client scope
-authproxy_scope_id = get_or_create_client_scope(keycloak_admin, {
-    "name": "authproxy-aud",
-    "protocol": "openid-connect",
-    "attributes": {
-        "include.in.token.scope": "true",
-        "display.on.consent.screen": "true"
-    }
-})
-add_audience_mapper(keycloak_admin, authproxy_scope_id, "authproxy-aud", "authproxy")
-
-# Create `demoapp-aud` Client scope
-demoapp_scope_id = get_or_create_client_scope(keycloak_admin, {
-    "name": "demoapp-aud",
-    "protocol": "openid-connect",
-    "attributes": {
-        "include.in.token.scope": "true",
-        "display.on.consent.screen": "true"
+        logger.error(f"Failed to add mapper '{mapper_name}': {e}")
+        return False
+
+def add_client_default_scope(keycloak_admin, client_id, client_name, scope_id, scope_name):
+    """
+    Assigns a client scope as a default scope of a client unless it already is one.
+    Returns whether the client has the default scope afterwards.
+    """
+    if client_id not in _client_default_scope_cache:
+        scopes = keycloak_admin.get_client_default_client_scopes(client_id)
+        _client_default_scope_cache[client_id] = {s['id'] for s in scopes}
+    assigned_scope_ids = _client_default_scope_cache[client_id]
+    if scope_id in assigned_scope_ids:
+        logger.info(f"'{scope_name}' is already a default scope of '{client_name}'.")
+        return True
+
+    try:
+        keycloak_admin.add_client_default_client_scope(client_id, scope_id, {})
+        assigned_scope_ids.add(scope_id)
+        logger.info(f"Assigned '{scope_name}' as default scope to '{client_name}'.")
+        return True
+    except Exception as e:
+        logger.warning(f"Note: Could not assign '{scope_name}' scope to '{client_name}': {e}")
+        return False
+
+def configure_logging():
+    """
+    Buffers step messages in memory and writes them to stdout in one go at exit, or as
+    soon as an error is logged, instead of issuing one write per message.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(logging.handlers.MemoryHandler(
+        capacity=1024, flushLevel=logging.ERROR, target=stream_handler
+    ))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def configure_http_pool(keycloak_admin):
+    """
+    Mounts a keep-alive pool with retries for transient server errors on the
+    admin client's requests session, so the burst of admin calls below reuses connections.
+    """
+    # Back off and retry while Keycloak is still starting or briefly overloaded. Read
+    # errors and error statuses are only retried for GET and PUT: a POST that reached
+    # Keycloak may already have created its object, and sending it again would fail
+    # the create with 409 Conflict. Connection errors are retried for every method,
+    # since those requests never reached Keycloak.
+    retries = Retry(
+        total=5,
+        connect=3,
+        read=3,
+        backoff_factor=0.25,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "PUT"]),
+        raise_on_status=False,
+    )
+    session = keycloak_admin.connection._s
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retries
+        ))
+    session.hooks["response"].append(decode_with_orjson)
+
+def decode_with_orjson(response, *args, **kwargs):
+    """
+    Response hook parsing the admin API's JSON with orjson instead of the stdlib decoder.
+    """
+    # orjson.JSONDecodeError is a ValueError, which python-keycloak already handles
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+def load_realm_caches(keycloak_admin):
+    """
+    Fetches the current realm's client scopes and clients once and indexes them.
+    """
+    scopes = keycloak_admin.get_client_scopes()
+    _scope_cache.clear()
+    _scope_cache.update({s['name']: s for s in scopes})
+    _client_cache.clear()
+    _client_cache.update({c['clientId']: c for c in keycloak_admin.get_clients()})
+    _mapper_cache.clear()
+    _mapper_cache.update({s['id']: {m['name'] for m in s.get('protocolMappers', [])} for s in scopes})
+    _client_default_scope_cache.clear()
+
+def setup_fingerprint():
+    """
+    Hashes the desired realm contents so a re-run can tell whether the realm already has them.
+    The test user's password is left out: the hash is stored in a readable realm attribute,
+    and get_or_create_user() never changes the password of an existing user anyway.
+    """
+    state = {
+        "user": {k: v for k, v in TEST_USER.items() if k != "password"},
+        "clients": CLIENTS,
+        "client_scopes": CLIENT_SCOPES,
+        "audience_mappers": AUDIENCE_MAPPERS,
+        "default_scope_assignments": DEFAULT_SCOPE_ASSIGNMENTS,
     }
-})
-add_audience_mapper(keycloak_admin, demoapp_scope_id, "demoapp-aud", "demoapp")
-
-# Assign default scopes
-try:
-    keycloak_admin.add_client_default_client_scope(app_caller_id, authproxy_scope_id, {})
-    print("Assigned 'authproxy-aud' as default scope to 'application-caller'.")
-except Exception as e:
-    # Keycloak might raise error if already assigned
-    print(f"Note: Could not assign 'authproxy-aud' scope (might already exist): {e}")
-
-# Add 'demoapp-aud' to 'authproxy' as default
-try:
-    keycloak_admin.add_client_default_client_scope(authproxy_id, demoapp_scope_id, {})
-    print("Assigned 'demoapp-aud' as default scope to 'authproxy'.")
-except Exception as e:
-    print(f"Note: Could not assign 'demoapp-aud' scope (might already exist): {e}")
-
-print("-" * 50)
-try:
-    secret = keycloak_admin.get_client_secrets(app_caller_id)['value']
-    print(f"Run the following command to set the client secret:")
-    print(f"export CLIENT_SECRET={secret}")
-except Exception as e:
-    print(f"Could not retrieve secret: {e}")
-print("-" * 50)
\ No newline at end of file
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+def get_client_secret(keycloak_admin, client_id):
+    """
+    Returns a client's secret. The realm's client listing already includes the secrets
+    of confidential clients, so only a client created by this run needs a lookup.
+    """
+    client = _client_cache[client_id]
+    secret = client.get('secret')
+    if not secret:
+        secret = keycloak_admin.get_client_secrets(client['id'])['value']
+        client['secret'] = secret
+    return secret
+
+def print_client_secret(keycloak_admin, client_id):
+    logger.info("-" * 50)
+    try:
+        secret = get_client_secret(keycloak_admin, client_id)
+        logger.info("Run the following command to set the client secret:")
+        logger.info(f"export CLIENT_SECRET={secret}")
+    except Exception as e:
+        logger.error(f"Could not retrieve secret: {e}")
+    logger.info("-" * 50)
+
+def setup(keycloak_admin, skip_if_unchanged=False):
+    """
+    Provisions the quickstart users, clients and client scopes in the admin client's
+    current realm. Callers can reuse one KeycloakAdmin across calls (switching realms
+    with change_current_realm) so its token and connections are shared.
+
+    With skip_if_unchanged, a realm whose recorded setup fingerprint matches is left
+    untouched and only the client secret is looked up. The fingerprint is recorded
+    after a run in which every step succeeded.
+    """
+    realm_name = keycloak_admin.get_current_realm()
+    fingerprint = setup_fingerprint()
+    if skip_if_unchanged:
+        attributes = keycloak_admin.get_realm(realm_name).get("attributes") or {}
+        if attributes.get(SETUP_FINGERPRINT_ATTRIBUTE) == fingerprint:
+            logger.info(f"Realm '{realm_name}' already has this setup (fingerprint unchanged), skipping.")
+            _client_cache.clear()
+            _client_cache.update({c['clientId']: c for c in keycloak_admin.get_clients()})
+            print_client_secret(keycloak_admin, "application-caller")
+            return
+
+    load_realm_caches(keycloak_admin)
+    preexisting_scopes = set(_scope_cache)
+    audiences = dict(AUDIENCE_MAPPERS)
+
+    # The test user, both clients and both client scopes are independent of each
+    # other, so create them concurrently; the steps after the executor block need
+    # their IDs and only run once every create has finished
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        user_future = executor.submit(
+            get_or_create_user, keycloak_admin, TEST_USER["username"], TEST_USER["password"]
+        )
+        client_futures = {
+            client["clientId"]: executor.submit(get_or_create_client, keycloak_admin, client)
+            for client in CLIENTS
+        }
+        scope_futures = {
+            scope["name"]: executor.submit(
+                get_or_create_client_scope, keycloak_admin, scope,
+                [audience_mapper_payload(scope["name"], audiences[scope["name"]])]
+            )
+            for scope in CLIENT_SCOPES
+        }
+
+    user_future.result()
+    client_ids = {name: future.result() for name, future in client_futures.items()}
+    scope_ids = {name: future.result() for name, future in scope_futures.items()}
+
+    # Mapper repairs for scopes that already existed and the default-scope assignments
+    # only need the IDs from above and don't depend on each other (python-keycloak has
+    # no bulk assignment call), so issue them concurrently as well
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                add_audience_mapper, keycloak_admin, scope_ids[scope_name], scope_name, audience
+            )
+            for scope_name, audience in AUDIENCE_MAPPERS
+            if scope_name in preexisting_scopes
+        ] + [
+            executor.submit(
+                add_client_default_scope,
+                keycloak_admin, client_ids[client_name], client_name, scope_ids[scope_name], scope_name
+            )
+            for client_name, scope_name in DEFAULT_SCOPE_ASSIGNMENTS
+        ]
+    succeeded = all([future.result() for future in futures])
+
+    # Record the fingerprint only for a complete setup, otherwise the next
+    # skip_if_unchanged run would skip retrying the steps that failed
+    if skip_if_unchanged and not succeeded:
+        logger.warning("Note: Not recording the setup fingerprint because some steps "
+                       "failed; the next run will retry them.")
+    elif skip_if_unchanged:
+        try:
+            keycloak_admin.update_realm(realm_name, {
+                "attributes": {SETUP_FINGERPRINT_ATTRIBUTE: fingerprint}
+            })
+        except Exception as e:
+            logger.warning(f"Note: Could not record setup fingerprint on realm '{realm_name}': {e}")
+
+    print_client_secret(keycloak_admin, "application-caller")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set up Keycloak for the AuthProxy quickstart")
+    parser.add_argument(
+        "--skip-if-unchanged",
+        action="store_true",
+        help="Skip all Keycloak changes when the realm records that this exact setup was "
+             "already applied (changes made outside this script are not detected)"
+    )
+    args = parser.parse_args()
+    configure_logging()
+
+    # initialize keycloak admin client
+    logger.info(f"Connecting to Keycloak at {KEYCLOAK_URL} as {KEYCLOAK_ADMIN_USERNAME}...")
+    keycloak_admin = KeycloakAdmin(
+        server_url=KEYCLOAK_URL,
+        username=KEYCLOAK_ADMIN_USERNAME,
+        password=KEYCLOAK_ADMIN_PASSWORD,
+        realm_name=KEYCLOAK_REALM,
+        user_realm_name="master",
+        timeout=KEYCLOAK_TIMEOUT
+    )
+    configure_http_pool(keycloak_admin)
+    setup(keycloak_admin, skip_if_unchanged=args.skip_if_unchanged)
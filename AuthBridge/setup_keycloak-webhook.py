@@ -6,7 +6,7 @@ to inject AuthBridge sidecars. Unlike the standalone demo, this setup supports
 any namespace where the webhook is enabled.
 
 Usage:
-  python setup_keycloak-webhook.py [--namespace NAMESPACE] [--service-account SA]
+  python setup_keycloak-webhook.py [--namespace NAMESPACE] [--service-account SA] [--print-only]
 
 Examples:
   # Default: team1 namespace, agent service account
@@ -15,6 +15,9 @@ Examples:
   # Custom namespace and service account
   python setup_keycloak-webhook.py --namespace myapp --service-account mysa
 
+  # Only print the kubectl instructions for a namespace (no Keycloak access)
+  python setup_keycloak-webhook.py --namespace myapp --print-only
+
 Architecture:
   Workload with label 'kagenti.io/inject: enabled'
        ↓
@@ -42,9 +45,12 @@ Security Note:
 """
 
 import argparse
-import sys
+import logging
 import os
-from keycloak import KeycloakAdmin, KeycloakPostError
+import sys
+from keycloak_utils import KeycloakSetup, configure_logging, render_template
+
+logger = logging.getLogger("authbridge.webhook")
 
 # Default configuration
 # NOTE: The default admin credentials below ("admin"/"admin") are for demo and local
@@ -67,6 +73,9 @@ DEFAULT_NAMESPACE = "team1"
 DEFAULT_SERVICE_ACCOUNT = "agent"
 SPIFFE_TRUST_DOMAIN = "localtest.me"
 
+# Realm attribute holding the hash of the last setup, see --skip-if-unchanged
+SETUP_FINGERPRINT_ATTRIBUTE = "kagenti-webhook-setup-hash"
+
 # Demo user for demonstrating subject preservation
 DEMO_USER = {
     "username": "alice",
@@ -82,107 +91,62 @@ def get_spiffe_id(namespace: str, service_account: str) -> str:
     return f"spiffe://{SPIFFE_TRUST_DOMAIN}/ns/{namespace}/sa/{service_account}"
 
 
-def get_or_create_realm(keycloak_admin, realm_name):
-    """Create realm if it doesn't exist."""
-    try:
-        realms = keycloak_admin.get_realms()
-        for realm in realms:
-            if realm['realm'] == realm_name:
-                print(f"Realm '{realm_name}' already exists.")
-                return
-        keycloak_admin.create_realm({
-            "realm": realm_name,
-            "enabled": True,
-            "displayName": realm_name,
-        })
-        print(f"Created realm '{realm_name}'.")
-    except Exception as e:
-        print(f"Error checking/creating realm: {e}")
-
-
-def get_or_create_client(keycloak_admin, client_payload):
-    """Create client if doesn't exist, return internal client ID."""
-    client_id = client_payload['clientId']
-    existing_client_id = keycloak_admin.get_client_id(client_id)
-    if existing_client_id:
-        print(f"Client '{client_id}' already exists.")
-        return existing_client_id
-    internal_id = keycloak_admin.create_client(client_payload)
-    print(f"Created client '{client_id}'.")
-    return internal_id
-
-
-def get_or_create_client_scope(keycloak_admin, scope_payload):
-    """Create client scope if doesn't exist, return scope ID."""
-    scope_name = scope_payload.get("name")
-    scopes = keycloak_admin.get_client_scopes()
-    for scope in scopes:
-        if scope['name'] == scope_name:
-            print(f"Client scope '{scope_name}' already exists with ID: {scope['id']}")
-            return scope['id']
-
-    try:
-        scope_id = keycloak_admin.create_client_scope(scope_payload)
-        print(f"Created client scope '{scope_name}': {scope_id}")
-        return scope_id
-    except KeycloakPostError as e:
-        print(f"Could not create client scope '{scope_name}': {e}")
-        raise
-
-
-def add_audience_mapper(keycloak_admin, scope_id, mapper_name, audience):
-    """Add audience protocol mapper to a client scope."""
-    mapper_payload = {
-        "name": mapper_name,
-        "protocol": "openid-connect",
-        "protocolMapper": "oidc-audience-mapper",
-        "consentRequired": False,
-        "config": {
-            "included.custom.audience": audience,
-            "id.token.claim": "false",
-            "access.token.claim": "true",
-            "userinfo.token.claim": "false"
-        }
+def setup_config(namespace: str, service_account: str) -> dict:
+    """Describe the realm contents an agent in namespace/service_account needs."""
+    return {
+        "clients": [
+            # auth-target client (required as token exchange audience target)
+            {
+                "clientId": "auth-target",
+                "name": "Auth Target",
+                "enabled": True,
+                "publicClient": False,
+                "standardFlowEnabled": False,
+                "serviceAccountsEnabled": True,
+                "attributes": {
+                    "standard.token.exchange.enabled": "true"
+                }
+            },
+        ],
+        "client_scopes": [
+            # Adds the Agent's SPIFFE ID to every token's audience (realm default)
+            {
+                "name": f"agent-{namespace}-{service_account}-aud",
+                "audience": get_spiffe_id(namespace, service_account),
+                "realm_scope": "default",
+            },
+            # Adds "auth-target" to exchanged tokens (realm optional)
+            {
+                "name": "auth-target-aud",
+                "audience": "auth-target",
+                "realm_scope": "optional",
+            },
+        ],
+        # alice demonstrates subject preservation during token exchange
+        "users": [DEMO_USER],
     }
-    
-    try:
-        keycloak_admin.add_mapper_to_client_scope(scope_id, mapper_payload)
-        print(f"Added audience mapper '{mapper_name}' for audience '{audience}'")
-    except Exception as e:
-        # Mapper might already exist
-        print(f"Note: Could not add mapper '{mapper_name}' (might already exist): {e}")
 
 
-def get_or_create_user(keycloak_admin, user_config):
-    """Create a demo user if it doesn't exist."""
-    username = user_config["username"]
-    
-    # Check if user exists
-    users = keycloak_admin.get_users({"username": username})
-    if users:
-        print(f"User '{username}' already exists.")
-        return users[0]["id"]
-    
-    # Create user
+def provision_keycloak(namespace, service_account, skip_if_unchanged=False):
+    """Connect to Keycloak and create the realm, clients, scopes and user for the agent."""
+    logger.info(f"\nConnecting to Keycloak at {KEYCLOAK_URL}...")
     try:
-        user_id = keycloak_admin.create_user({
-            "username": username,
-            "email": user_config["email"],
-            "firstName": user_config["firstName"],
-            "lastName": user_config["lastName"],
-            "enabled": True,
-            "emailVerified": True,
-            "credentials": [{
-                "type": "password",
-                "value": user_config["password"],
-                "temporary": False
-            }]
-        })
-        print(f"Created user '{username}' with ID: {user_id}")
-        return user_id
-    except KeycloakPostError as e:
-        print(f"Could not create user '{username}': {e}")
-        raise
+        keycloak_setup = KeycloakSetup(
+            KEYCLOAK_URL, KEYCLOAK_ADMIN_USERNAME, KEYCLOAK_ADMIN_PASSWORD, KEYCLOAK_REALM
+        )
+    except Exception as e:
+        logger.error(f"Failed to connect to Keycloak: {e}")
+        logger.info("\nMake sure Keycloak is running and accessible at:")
+        logger.info(f"  {KEYCLOAK_URL}")
+        logger.info("\nIf using port-forward, run:")
+        logger.info("  kubectl port-forward service/keycloak-service -n keycloak 8080:8080")
+        sys.exit(1)
+
+    config = setup_config(namespace, service_account)
+    logger.info(f"Scope for Agent's SPIFFE ID audience: {config['client_scopes'][0]['name']}")
+    keycloak_setup.apply(
+        config, fingerprint_attribute=SETUP_FINGERPRINT_ATTRIBUTE if skip_if_unchanged else None
+    )
 
 
 def main():
@@ -199,240 +163,62 @@ def main():
         default=DEFAULT_SERVICE_ACCOUNT,
         help=f"Service account name for the agent (default: {DEFAULT_SERVICE_ACCOUNT})"
     )
+    parser.add_argument(
+        "--skip-if-unchanged",
+        action="store_true",
+        help="Skip all Keycloak changes when the realm records that this exact setup was "
+             "already applied (changes made outside this script are not detected)"
+    )
+    parser.add_argument(
+        "--print-only",
+        action="store_true",
+        help="Only print the deployment instructions, without connecting to Keycloak"
+    )
     args = parser.parse_args()
+    configure_logging()
 
     namespace = args.namespace
     service_account = args.service_account
     agent_spiffe_id = get_spiffe_id(namespace, service_account)
 
-    print("=" * 70)
-    print("AuthBridge Webhook - Keycloak Setup")
-    print("=" * 70)
-    print(f"\nNamespace:       {namespace}")
-    print(f"Service Account: {service_account}")
-    print(f"SPIFFE ID:       {agent_spiffe_id}")
-    
-    # Connect to Keycloak master realm first
-    print(f"\nConnecting to Keycloak at {KEYCLOAK_URL}...")
-    try:
-        master_admin = KeycloakAdmin(
-            server_url=KEYCLOAK_URL,
-            username=KEYCLOAK_ADMIN_USERNAME,
-            password=KEYCLOAK_ADMIN_PASSWORD,
-            realm_name="master",
-            user_realm_name="master"
-        )
-    except Exception as e:
-        print(f"Failed to connect to Keycloak: {e}")
-        print("\nMake sure Keycloak is running and accessible at:")
-        print(f"  {KEYCLOAK_URL}")
-        print("\nIf using port-forward, run:")
-        print("  kubectl port-forward service/keycloak-service -n keycloak 8080:8080")
-        sys.exit(1)
-    
-    # Create demo realm if needed
-    print(f"\n--- Setting up realm: {KEYCLOAK_REALM} ---")
-    get_or_create_realm(master_admin, KEYCLOAK_REALM)
-    
-    # Switch to demo realm
-    keycloak_admin = KeycloakAdmin(
-        server_url=KEYCLOAK_URL,
-        username=KEYCLOAK_ADMIN_USERNAME,
-        password=KEYCLOAK_ADMIN_PASSWORD,
-        realm_name=KEYCLOAK_REALM,
-        user_realm_name="master"
-    )
-    
-    # Create auth-target client (required as token exchange audience target)
-    print("\n--- Creating auth-target client ---")
-    print("This client is required as the target audience for token exchange")
-    get_or_create_client(keycloak_admin, {
-        "clientId": "auth-target",
-        "name": "Auth Target",
-        "enabled": True,
-        "publicClient": False,
-        "standardFlowEnabled": False,
-        "serviceAccountsEnabled": True,
-        "attributes": {
-            "standard.token.exchange.enabled": "true"
-        }
-    })
-    
-    # Create client scopes
-    print("\n--- Creating client scopes ---")
-    
-    # agent-spiffe-aud scope - adds Agent's SPIFFE ID to token audience (realm default)
-    scope_name = f"agent-{namespace}-{service_account}-aud"
-    print(f"\nCreating scope for Agent's SPIFFE ID audience: {scope_name}")
-    agent_spiffe_scope_id = get_or_create_client_scope(keycloak_admin, {
-        "name": scope_name,
-        "protocol": "openid-connect",
-        "attributes": {
-            "include.in.token.scope": "true",
-            "display.on.consent.screen": "true"
-        }
-    })
-    add_audience_mapper(keycloak_admin, agent_spiffe_scope_id, scope_name, agent_spiffe_id)
-    
-    # auth-target-aud scope - added to exchanged tokens
-    auth_target_scope_id = get_or_create_client_scope(keycloak_admin, {
-        "name": "auth-target-aud",
-        "protocol": "openid-connect",
-        "attributes": {
-            "include.in.token.scope": "true",
-            "display.on.consent.screen": "true"
-        }
-    })
-    add_audience_mapper(keycloak_admin, auth_target_scope_id, "auth-target-aud", "auth-target")
-    
-    # Assign scopes
-    print("\n--- Assigning scopes ---")
-    
-    try:
-        keycloak_admin.add_default_default_client_scope(agent_spiffe_scope_id)
-        print(f"Added '{scope_name}' as realm default scope.")
-    except Exception as e:
-        print(f"Note: Could not add '{scope_name}' as realm default (might already exist): {e}")
-    
-    try:
-        keycloak_admin.add_default_optional_client_scope(auth_target_scope_id)
-        print("Added 'auth-target-aud' as realm OPTIONAL scope.")
-    except Exception as e:
-        print(f"Note: Could not add 'auth-target-aud' as optional scope (might already exist): {e}")
-    
-    # Create demo user
-    print("\n--- Creating demo user ---")
-    print("This user demonstrates subject preservation during token exchange")
-    get_or_create_user(keycloak_admin, DEMO_USER)
-    
-    # Print summary and next steps
-    print("\n" + "=" * 70)
-    print("SETUP COMPLETE")
-    print("=" * 70)
-    
-    print("\n" + "=" * 70)
-    print("REQUIRED CONFIGMAPS")
-    print("=" * 70)
-    print(f"""
-Create these ConfigMaps in the {namespace} namespace:
-
-# 1. environments ConfigMap (for client-registration)
-kubectl create configmap environments -n {namespace} \\
-  --from-literal=SPIRE_ENABLED=true \\
-  --from-literal=KEYCLOAK_URL=http://keycloak-service.keycloak.svc:8080 \\
-  --from-literal=KEYCLOAK_REALM=demo \\
-  --from-literal=KEYCLOAK_ADMIN_USERNAME=admin \\
-  --from-literal=KEYCLOAK_ADMIN_PASSWORD=admin
-
-# 2. authbridge-config ConfigMap (for envoy-proxy)
-kubectl create configmap authbridge-config -n {namespace} \\
-  --from-literal=TOKEN_URL=http://keycloak-service.keycloak.svc:8080/realms/demo/protocol/openid-connect/token \\
-  --from-literal=TARGET_AUDIENCE=auth-target \\
-  --from-literal=TARGET_SCOPES="openid auth-target-aud"
-
-# 3. spiffe-helper-config ConfigMap (for SPIRE-enabled mode)
-kubectl apply -f - <<EOF
-apiVersion: v1
-kind: ConfigMap
-metadata:
-  name: spiffe-helper-config
-  namespace: {namespace}
-data:
-  helper.conf: |
-    agent_address = "/spiffe-workload-api/spire-agent.sock"
-    cmd = ""
-    cmd_args = ""
-    svid_file_name = "/opt/svid.pem"
-    svid_key_file_name = "/opt/svid_key.pem"
-    svid_bundle_file_name = "/opt/svid_bundle.pem"
-    jwt_svids = [{{jwt_audience="kagenti", jwt_svid_file_name="/opt/jwt_svid.token"}}]
-    jwt_svid_file_mode = 0644
-EOF
-
-# 4. envoy-config ConfigMap (for envoy-proxy)
-# Copy from AuthBridge/k8s/authbridge-deployment.yaml or use:
-kubectl get configmap envoy-config -n authbridge -o yaml | \\
-  sed 's/namespace: authbridge/namespace: {namespace}/' | \\
-  kubectl apply -f -
-""")
-
-    print("\n" + "=" * 70)
-    print("DEPLOY WITH WEBHOOK")
-    print("=" * 70)
-    print(f"""
-# Create ServiceAccount
-kubectl create serviceaccount {service_account} -n {namespace}
-
-# Deploy with webhook injection (SPIRE enabled)
-kubectl apply -f - <<EOF
-apiVersion: apps/v1
-kind: Deployment
-metadata:
-  name: agent
-  namespace: {namespace}
-  labels:
-    app: agent
-    kagenti.io/inject: enabled
-    kagenti.io/spire: enabled
-spec:
-  replicas: 1
-  selector:
-    matchLabels:
-      app: agent
-  template:
-    metadata:
-      labels:
-        app: agent
-    spec:
-      serviceAccountName: {service_account}
-      containers:
-        - name: agent
-          image: nicolaka/netshoot:latest
-          command: ["sh", "-c", "while [ ! -f /shared/client-id.txt ]; do sleep 2; done; echo Ready; tail -f /dev/null"]
-          volumeMounts:
-            - name: shared-data
-              mountPath: /shared
-EOF
-""")
-
-    print("\n" + "=" * 70)
-    print("TEST THE SETUP")
-    print("=" * 70)
-    print(f"""
-# Wait for pod to be ready
-kubectl wait --for=condition=available --timeout=180s deployment/agent -n {namespace}
-
-# Exec into the agent container
-kubectl exec -it deployment/agent -n {namespace} -c agent -- sh
-
-# Inside the container:
-CLIENT_ID=$(cat /shared/client-id.txt)
-CLIENT_SECRET=$(cat /shared/client-secret.txt)
-
-# Get a token
-TOKEN=$(curl -sX POST http://keycloak-service.keycloak.svc:8080/realms/demo/protocol/openid-connect/token \\
-  -d 'grant_type=client_credentials' \\
-  -d "client_id=$CLIENT_ID" \\
-  -d "client_secret=$CLIENT_SECRET" | jq -r '.access_token')
-
-# Verify token (should have aud: {agent_spiffe_id})
-echo $TOKEN | cut -d'.' -f2 | tr '_-' '/+' | {{ read p; echo "${{p}}=="; }} | base64 -d | jq '{{aud, azp, scope}}'
-
-# Call auth-target (token exchange happens transparently)
-curl -H "Authorization: Bearer $TOKEN" http://auth-target-service.authbridge:8081/test
-# Expected: "authorized"
-
-# Test with user token (demonstrates subject preservation)
-USER_TOKEN=$(curl -sX POST http://keycloak-service.keycloak.svc:8080/realms/demo/protocol/openid-connect/token \\
-  -d 'grant_type=password' \\
-  -d "client_id=$CLIENT_ID" \\
-  -d "client_secret=$CLIENT_SECRET" \\
-  -d 'username={DEMO_USER["username"]}' \\
-  -d 'password={DEMO_USER["password"]}' | jq -r '.access_token')
-
-# Check alice's subject is preserved
-echo $USER_TOKEN | cut -d'.' -f2 | tr '_-' '/+' | {{ read p; echo "${{p}}=="; }} | base64 -d | jq '{{sub, preferred_username, aud}}'
-""")
+    logger.info("=" * 70)
+    logger.info("AuthBridge Webhook - Keycloak Setup")
+    logger.info("=" * 70)
+    logger.info(f"\nNamespace:       {namespace}")
+    logger.info(f"Service Account: {service_account}")
+    logger.info(f"SPIFFE ID:       {agent_spiffe_id}")
+    
+    if args.print_only:
+        logger.info("\n--print-only: skipping Keycloak setup.")
+    else:
+        provision_keycloak(namespace, service_account, args.skip_if_unchanged)
+
+        logger.info("\n" + "=" * 70)
+        logger.info("SETUP COMPLETE")
+        logger.info("=" * 70)
+
+    logger.info("\n" + "=" * 70)
+    logger.info("REQUIRED CONFIGMAPS")
+    logger.info("=" * 70)
+    logger.info(render_template("webhook-required-configmaps.tmpl", namespace=namespace))
+
+    logger.info("\n" + "=" * 70)
+    logger.info("DEPLOY WITH WEBHOOK")
+    logger.info("=" * 70)
+    logger.info(render_template(
+        "webhook-deploy.tmpl", namespace=namespace, service_account=service_account
+    ))
+
+    logger.info("\n" + "=" * 70)
+    logger.info("TEST THE SETUP")
+    logger.info("=" * 70)
+    logger.info(render_template(
+        "webhook-test-setup.tmpl",
+        namespace=namespace,
+        agent_spiffe_id=agent_spiffe_id,
+        demo_username=DEMO_USER["username"],
+        demo_password=DEMO_USER["password"],
+    ))
 
 
 if __name__ == "__main__":